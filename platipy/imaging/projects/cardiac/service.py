@@ -15,6 +15,9 @@
 
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import SimpleITK as sitk
 from loguru import logger
 
@@ -28,105 +31,214 @@ from platipy.imaging.projects.cardiac.run import (
     CARDIAC_SETTINGS_DEFAULTS,
     run_cardiac_segmentation,
 )
+from platipy.imaging.registration.utils import load_as_float32
 
 
-@app.register("Cardiac Segmentation", default_settings=CARDIAC_SETTINGS_DEFAULTS)
-def cardiac_service(data_objects, working_dir, settings):
+def _is_binary_mask(image):
+    """Check whether an image is a binary (0/1) label."""
+    if image.GetNumberOfComponentsPerPixel() > 1:
+        return False
+
+    stats = sitk.MinimumMaximumImageFilter()
+    stats.Execute(image)
+    return stats.GetMinimum() >= 0 and stats.GetMaximum() <= 1
+
+
+def _write_combined_masks(results, output_dir):
     """
-    Implements the platipy framework to provide cardiac atlas based segmentation.
+    Combine the output masks into a single volume and write it once, rather
+    than one file (with its own header construction and gzip stream) per
+    structure. Disjoint masks are merged into a uint8 label map, which also
+    compresses far better than one-hot binary volumes; overlapping masks
+    fall back to a 4D stack along a trailing structure axis. Non-mask
+    results (e.g. the cropped image when return_as_cropped is set) are
+    written separately in their native pixel type. Returns a list of
+    (file path, meta data) pairs.
     """
+    output_files = []
 
-    logger.info("Running Cardiac Segmentation")
-    logger.info("Using settings: " + str(settings))
+    structures = [name for name in results if _is_binary_mask(results[name])]
+    for name in set(results) - set(structures):
+        other_file = os.path.join(output_dir, "{0}.nii.gz".format(name))
+        sitk.WriteImage(results[name], other_file)
+        output_files.append((other_file, None))
 
-    output_objects = []
-    for data_object in data_objects:
-        logger.info("Running on data object: " + data_object.path)
+    if not structures:
+        return output_files
 
-        # Read the image series
-        load_path = data_object.path
-        if data_object.type == "DICOM":
-            load_path = sitk.ImageSeriesReader().GetGDCMSeriesFileNames(data_object.path)
+    masks = [sitk.Cast(results[name], sitk.sitkUInt8) for name in structures]
+    stacked = np.stack([sitk.GetArrayViewFromImage(mask) for mask in masks])
 
-        img = sitk.ReadImage(load_path)
+    mask_file = os.path.join(output_dir, "structures.nii.gz")
 
-        results, _ = run_cardiac_segmentation(img, settings=settings)
+    if not (stacked.sum(axis=0) > 1).any():
+        label_arr = np.zeros(stacked.shape[1:], dtype=np.uint8)
+        for label, mask_arr in enumerate(stacked, start=1):
+            label_arr[mask_arr > 0] = label
+        combined = sitk.GetImageFromArray(label_arr)
+        combined.CopyInformation(masks[0])
+        meta_data = {"labels": {name: label for label, name in enumerate(structures, start=1)}}
+    else:
+        combined = sitk.JoinSeries(masks)
+        meta_data = {"structure_index": {name: index for index, name in enumerate(structures)}}
 
-        # Save resulting masks and add to output for service
-        for output in results:
+    sitk.WriteImage(combined, mask_file)
+    output_files.append((mask_file, meta_data))
 
-            mask_file = os.path.join(working_dir, "{0}.nii.gz".format(output))
-            sitk.WriteImage(results[output], mask_file)
+    return output_files
 
-            output_data_object = DataObject(type="FILE", path=mask_file, parent=data_object)
-            output_objects.append(output_data_object)
 
-        # If the input was a DICOM, then we can use it to generate an output RTStruct
-        # if data_object.type == "DICOM":
+def _segment_case(input_path, input_type, guide_structure_path, settings, output_dir):
+    """
+    Run cardiac segmentation for a single image, writing the resulting
+    masks into output_dir. Takes only plain paths, so it is safe to run on
+    a worker thread. Returns a list of (file path, meta data) pairs.
+    """
+    logger.info("Running on data object: " + input_path)
 
-        #     dicom_file = load_path[0]
-        #     logger.info("Will write Dicom using file: {0}".format(dicom_file))
-        #     masks = {settings["outputContourName"]: mask_file}
+    # Read the image series directly as float32: the registration stages
+    # all work in float32, so folding the cast into the read avoids a
+    # full-volume conversion pass later. For DICOM, a single reader walks
+    # the directory once and skips metadata dictionary population and
+    # private tags: the segmentation only needs voxel data and geometry.
+    if input_type == "DICOM":
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames(reader.GetGDCMSeriesFileNames(input_path))
+        reader.MetaDataDictionaryArrayUpdateOff()
+        reader.LoadPrivateTagsOff()
+        reader.SetOutputPixelType(sitk.sitkFloat32)
+        img = reader.Execute()
+    else:
+        img = load_as_float32(input_path)
 
-        #     # Use the image series UID for the file of the RTStruct
-        #     suid = pydicom.dcmread(dicom_file).SeriesInstanceUID
-        #     output_file = os.path.join(working_dir, "RS.{0}.dcm".format(suid))
+    guide_structure = None
+    if guide_structure_path:
+        guide_structure = sitk.ReadImage(guide_structure_path)
 
-        #     # Use the convert nifti function to generate RTStruct from nifti masks
-        #     convert_nifti(dicom_file, masks, output_file)
+    results, _ = run_cardiac_segmentation(img, guide_structure, settings)
 
-        #     # Create the Data Object for the RTStruct and add it to the list
-        #     do = DataObject(type="DICOM", path=output_file, parent=d)
-        #     output_objects.append(do)
+    # Save resulting masks as a single combined volume
+    output_files = _write_combined_masks(results, output_dir)
 
-        #     logger.info("RTStruct generated")
+    # If the input was a DICOM, then we can use it to generate an output RTStruct
+    # if input_type == "DICOM":
 
-    return output_objects
+    #     dicom_file = reader.GetFileNames()[0]
+    #     logger.info("Will write Dicom using file: {0}".format(dicom_file))
+    #     masks = {settings["outputContourName"]: mask_file}
 
+    #     # Use the image series UID for the file of the RTStruct
+    #     suid = pydicom.dcmread(dicom_file).SeriesInstanceUID
+    #     output_file = os.path.join(working_dir, "RS.{0}.dcm".format(suid))
 
-@app.register(
-    "Cardiac Structure Guided Segmentation",
-    default_settings=CARDIAC_SETTINGS_DEFAULTS,
-)
-def cardiac_structure_guided_service(data_objects, working_dir, settings):
-    """Runs the structure guided cardiac segmentation service"""
+    #     # Use the convert nifti function to generate RTStruct from nifti masks
+    #     convert_nifti(dicom_file, masks, output_file)
 
-    logger.info("Running Structure Guided Cardiac Segmentation")
-    logger.info("Using settings: " + str(settings))
+    #     logger.info("RTStruct generated")
 
-    output_objects = []
-    for data_object in data_objects:
-        logger.info("Running on data object: " + data_object.path)
+    return output_files
 
-        # Read the image series
-        load_path = data_object.path
-        if data_object.type == "DICOM":
-            load_path = sitk.ImageSeriesReader().GetGDCMSeriesFileNames(data_object.path)
 
-        img = sitk.ReadImage(load_path)
+def _segment_data_objects(data_objects, working_dir, settings, structure_guided=False):
+    """
+    Run cardiac segmentation over the given data objects. A single data
+    object is processed inline; several are fanned out over a thread pool.
+    The segmentations are independent and spend nearly all their time inside
+    SimpleITK registration filters, which release the GIL, so threads scale
+    across data objects. The DataObject rows are bound to the database
+    session, which is not thread-safe (and rules out a process pool), so
+    every attribute access and all DataObject construction happens here on
+    the calling thread — the workers only ever see plain paths.
+    """
+    # Resolve everything the workers need from the data objects up front
+    cases = []
+    for data_object in data_objects:
+        guide_structure_path = None
+        if structure_guided:
+            # The WHOLEHEART contour is a child of the image
+            if len(data_object.children) == 0:
+                logger.error(
+                    "Wholeheart structure needed for structure guided cardiac "
+                    f"segmentation, skipping {data_object.id}"
+                )
+                continue
+            guide_structure_path = data_object.children[0].path
+
+        if len(data_objects) < 2:
+            output_dir = working_dir
+        else:
+            # Separate output directories keep the identically named masks
+            # of concurrent data objects apart
+            output_dir = os.path.join(working_dir, str(data_object.id))
+            os.makedirs(output_dir, exist_ok=True)
+
+        cases.append(
+            (data_object, data_object.path, data_object.type, guide_structure_path, output_dir)
+        )
+
+    output_objects = []
 
-        # Load the WHOLEHEART contour (child of Image)
-        if len(data_object.children) == 0:
-            logger.error(
-                "Wholeheart structure needed for structure guided cardiac "
-                f"segmentation, skipping {data_object.id}"
+    if len(cases) < 2:
+        for data_object, input_path, input_type, guide_structure_path, output_dir in cases:
+            output_files = _segment_case(
+                input_path, input_type, guide_structure_path, settings, output_dir
+            )
+            output_objects += [
+                DataObject(type="FILE", path=path, parent=data_object, meta_data=meta_data)
+                for path, meta_data in output_files
+            ]
+        return output_objects
+
+    with ThreadPoolExecutor(
+        max_workers=min(len(cases), os.cpu_count() or 1)
+    ) as executor:
+        futures = [
+            (
+                data_object,
+                executor.submit(
+                    _segment_case,
+                    input_path,
+                    input_type,
+                    guide_structure_path,
+                    settings,
+                    output_dir,
+                ),
             )
-            continue
+            for data_object, input_path, input_type, guide_structure_path, output_dir in cases
+        ]
 
-        wholeheart = sitk.ReadImage(data_object.children[0].path)
+        for data_object, future in futures:
+            output_objects += [
+                DataObject(type="FILE", path=path, parent=data_object, meta_data=meta_data)
+                for path, meta_data in future.result()
+            ]
 
-        results, _ = run_cardiac_segmentation(img, wholeheart, settings)
+    return output_objects
 
-        # Save resulting masks and add to output for service
-        for output in results:
 
-            mask_file = os.path.join(working_dir, "{0}.nii.gz".format(output))
-            sitk.WriteImage(results[output], mask_file)
+@app.register("Cardiac Segmentation", default_settings=CARDIAC_SETTINGS_DEFAULTS)
+def cardiac_service(data_objects, working_dir, settings):
+    """
+    Implements the platipy framework to provide cardiac atlas based segmentation.
+    """
 
-            output_data_object = DataObject(type="FILE", path=mask_file, parent=data_object)
-            output_objects.append(output_data_object)
+    logger.info("Running Cardiac Segmentation")
+    logger.info("Using settings: " + str(settings))
 
-    return output_objects
+    return _segment_data_objects(data_objects, working_dir, settings)
+
+
+@app.register(
+    "Cardiac Structure Guided Segmentation",
+    default_settings=CARDIAC_SETTINGS_DEFAULTS,
+)
+def cardiac_structure_guided_service(data_objects, working_dir, settings):
+    """Runs the structure guided cardiac segmentation service"""
+
+    logger.info("Running Structure Guided Cardiac Segmentation")
+    logger.info("Using settings: " + str(settings))
+
+    return _segment_data_objects(data_objects, working_dir, settings, structure_guided=True)
 
 
 if __name__ == "__main__":
@@ -12,14 +12,69 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from functools import lru_cache
+
 import SimpleITK as sitk
 
 from platipy.imaging.registration.utils import (
+    DEFAULT_SAMPLING_SEED,
     apply_transform,
     registration_command_iteration,
+    resolve_work_units,
+    use_on_the_fly_gradients,
 )
 
 
+def _set_metric_as_correlation(registration):
+    registration.SetMetricAsCorrelation()
+    use_on_the_fly_gradients(registration)
+
+
+def _set_metric_as_mattes_mi(registration):
+    registration.SetMetricAsMattesMutualInformation()
+    use_on_the_fly_gradients(registration)
+
+
+def _set_metric_as_joint_hist_mi(registration):
+    registration.SetMetricAsJointHistogramMutualInformation()
+    use_on_the_fly_gradients(registration)
+
+
+# Metric dispatch table, built once at module load rather than re-evaluated
+# as an if/elif chain on every registration call
+AVAILABLE_METRICS = {
+    "correlation": _set_metric_as_correlation,
+    "mean_squares": sitk.ImageRegistrationMethod.SetMetricAsMeanSquares,
+    "mattes_mi": _set_metric_as_mattes_mi,
+    "joint_hist_mi": _set_metric_as_joint_hist_mi,
+}
+
+
+@lru_cache(maxsize=None)
+def _transform_factory(reg_method_name):
+    """
+    Resolve a (lower-case) registration method name to a transform
+    constructor. Cached so repeated registrations skip the name resolution;
+    each call of the returned factory still produces a fresh transform.
+    """
+    transforms = {
+        "translation": lambda: sitk.TranslationTransform(3),
+        "similarity": sitk.Similarity3DTransform,
+        "affine": lambda: sitk.AffineTransform(3),
+        "rigid": sitk.VersorRigid3DTransform,
+        "scale": lambda: sitk.ScaleTransform(3),
+        "scaleversor": sitk.ScaleVersor3DTransform,
+        "scaleskewversor": sitk.ScaleSkewVersor3DTransform,
+    }
+    try:
+        return transforms[reg_method_name]
+    except KeyError:
+        raise ValueError(
+            "You have selected a registration method that does not exist.\n Please select from"
+            " Translation, Similarity, Affine, Rigid, Scale, ScaleVersor, ScaleSkewVersor"
+        ) from None
+
+
 def alignment_registration(fixed_image, moving_image, moments=True):
     """
     A simple registration procedure that can align images in a single step.
@@ -37,13 +92,16 @@ def alignment_registration(fixed_image, moving_image, moments=True):
     """
 
     moving_image_type = moving_image.GetPixelIDValue()
-    fixed_image = sitk.Cast(fixed_image, sitk.sitkFloat32)
-    moving_image = sitk.Cast(moving_image, sitk.sitkFloat32)
+    if fixed_image.GetPixelID() != sitk.sitkFloat32:
+        fixed_image = sitk.Cast(fixed_image, sitk.sitkFloat32)
+    if moving_image.GetPixelID() != sitk.sitkFloat32:
+        moving_image = sitk.Cast(moving_image, sitk.sitkFloat32)
     initial_transform = sitk.CenteredTransformInitializer(
         fixed_image, moving_image, sitk.VersorRigid3DTransform(), moments
     )
-    aligned_image = sitk.Resample(moving_image, fixed_image, initial_transform)
-    aligned_image = sitk.Cast(aligned_image, moving_image_type)
+    aligned_image = sitk.Resample(
+        moving_image, fixed_image, initial_transform, sitk.sitkLinear, 0.0, moving_image_type
+    )
     return aligned_image, initial_transform
 
 
@@ -61,6 +119,7 @@ def linear_registration(
     final_interp=2,
     number_of_iterations=50,
     default_value=None,
+    ncores=None,
     verbose=False,
 ):
     """
@@ -112,6 +171,7 @@ def linear_registration(
         number_of_iterations (int, optional): Number of iterations in each multi-resolution step.
                                               Defaults to 50.
         default_value (int, optional): Default voxel value. Defaults to 0 unless image is CT-like.
+        ncores (int, optional): Number of CPU cores used. Defaults to all available cores.
         verbose (bool, optional): Print image registration process information. Defaults to False.
 
     Returns:
@@ -119,11 +179,13 @@ def linear_registration(
         [SimleITK.Transform]: The linear transformation.
     """
 
-    # Re-cast
-    fixed_image = sitk.Cast(fixed_image, sitk.sitkFloat32)
+    # Re-cast, if necessary
+    if fixed_image.GetPixelID() != sitk.sitkFloat32:
+        fixed_image = sitk.Cast(fixed_image, sitk.sitkFloat32)
 
     moving_image_type = moving_image.GetPixelIDValue()
-    moving_image = sitk.Cast(moving_image, sitk.sitkFloat32)
+    if moving_image.GetPixelID() != sitk.sitkFloat32:
+        moving_image = sitk.Cast(moving_image, sitk.sitkFloat32)
 
     # Initialise using a VersorRigid3DTransform
     initial_transform = sitk.CenteredTransformInitializer(
@@ -131,6 +193,7 @@ def linear_registration(
     )
     # Set up image registration method
     registration = sitk.ImageRegistrationMethod()
+    registration.SetNumberOfWorkUnits(resolve_work_units(ncores))
 
     registration.SetShrinkFactorsPerLevel(shrink_factors)
     registration.SetSmoothingSigmasPerLevel(smooth_sigmas)
@@ -138,18 +201,16 @@ def linear_registration(
 
     registration.SetMovingInitialTransform(initial_transform)
 
-    if metric.lower() == "correlation":
-        registration.SetMetricAsCorrelation()
-    elif metric.lower() == "mean_squares":
-        registration.SetMetricAsMeanSquares()
-    elif metric.lower() == "mattes_mi":
-        registration.SetMetricAsMattesMutualInformation()
-    elif metric.lower() == "joint_hist_mi":
-        registration.SetMetricAsJointHistogramMutualInformation()
-    # to do: add the rest
+    try:
+        AVAILABLE_METRICS[metric.lower()](registration)
+    except KeyError:
+        raise ValueError(
+            "You have selected a metric that does not exist.\n Please select from "
+            f"{', '.join(AVAILABLE_METRICS)}."
+        ) from None
 
     registration.SetInterpolator(sitk.sitkLinear)  # Perhaps a small gain in improvement
-    registration.SetMetricSamplingPercentage(sampling_rate)
+    registration.SetMetricSamplingPercentage(sampling_rate, DEFAULT_SAMPLING_SEED)
     registration.SetMetricSamplingStrategy(sitk.ImageRegistrationMethod.REGULAR)
 
     # This is only necessary if using a transform comprising changes with different units
@@ -158,31 +219,13 @@ def linear_registration(
     registration.SetOptimizerScalesFromPhysicalShift()
 
     if moving_structure:
-        registration.SetMetricMovingMask(moving_structure)
+        registration.SetMetricMovingMask(sitk.Cast(moving_structure, sitk.sitkUInt8))
 
     if fixed_structure:
-        registration.SetMetricFixedMask(fixed_structure)
+        registration.SetMetricFixedMask(sitk.Cast(fixed_structure, sitk.sitkUInt8))
 
     if isinstance(reg_method, str):
-        if reg_method.lower() == "translation":
-            registration.SetInitialTransform(sitk.TranslationTransform(3))
-        elif reg_method.lower() == "similarity":
-            registration.SetInitialTransform(sitk.Similarity3DTransform())
-        elif reg_method.lower() == "affine":
-            registration.SetInitialTransform(sitk.AffineTransform(3))
-        elif reg_method.lower() == "rigid":
-            registration.SetInitialTransform(sitk.VersorRigid3DTransform())
-        elif reg_method.lower() == "scale":
-            registration.SetInitialTransform(sitk.ScaleTransform(3))
-        elif reg_method.lower() == "scaleversor":
-            registration.SetInitialTransform(sitk.ScaleVersor3DTransform())
-        elif reg_method.lower() == "scaleskewversor":
-            registration.SetInitialTransform(sitk.ScaleSkewVersor3DTransform())
-        else:
-            raise ValueError(
-                "You have selected a registration method that does not exist.\n Please select from"
-                " Translation, Similarity, Affine, Rigid, ScaleVersor, ScaleSkewVersor"
-            )
+        registration.SetInitialTransform(_transform_factory(reg_method.lower())())
     elif isinstance(
         reg_method,
         (
@@ -253,8 +296,7 @@ def linear_registration(
         transform=combined_transform,
         default_value=default_value,
         interpolator=final_interp,
+        output_pixel_type=moving_image_type,
     )
 
-    registered_image = sitk.Cast(registered_image, moving_image_type)
-
     return registered_image, combined_transform
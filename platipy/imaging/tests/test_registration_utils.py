@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from platipy.imaging.registration.utils import (
+    HAS_CUCIM,
+    _convert_mask_to_distance_map_gpu,
+    apply_transform,
+    convert_mask_to_reg_structure,
+)
+
+
+def test_apply_transform_cubic_identity():
+
+    arr = np.random.RandomState(42).rand(16, 20, 24).astype(np.float32)
+    image = sitk.GetImageFromArray(arr)
+    image.SetSpacing((1.5, 1.5, 2.5))
+
+    # An identity cubic resample must preserve the voxel values, for both
+    # the interpolator enum and the legacy integer order
+    for interpolator in (sitk.sitkBSpline, 3):
+        resampled = apply_transform(
+            input_image=image,
+            reference_image=image,
+            transform=sitk.Transform(),
+            interpolator=interpolator,
+        )
+        assert np.allclose(sitk.GetArrayFromImage(resampled), arr, atol=1e-5)
+
+
+def test_convert_mask_to_reg_structure_matches_maurer():
+
+    mask = sitk.Image(24, 24, 16, sitk.sitkUInt8)
+    mask.SetSpacing((1.5, 1.5, 2.5))
+    mask[6:18, 6:18, 4:12] = 1
+
+    reg_structure = convert_mask_to_reg_structure(mask)
+
+    # The normalised interior distances must follow the Maurer convention
+    # (zero distance on boundary foreground voxels)
+    reference = sitk.GetArrayFromImage(
+        sitk.SignedMaurerDistanceMap(
+            mask, insideIsPositive=True, squaredDistance=False, useImageSpacing=True
+        )
+    )
+    reference = np.where(sitk.GetArrayFromImage(mask) > 0, reference, 0)
+    reference /= reference.max()
+
+    assert np.allclose(sitk.GetArrayFromImage(reg_structure), reference, atol=1e-5)
+
+
+@pytest.mark.skipif(not HAS_CUCIM, reason="cupy/cucim not available")
+def test_distance_map_gpu_matches_cpu():
+
+    mask = sitk.Image(24, 24, 16, sitk.sitkUInt8)
+    mask.SetSpacing((1.5, 1.5, 2.5))
+    mask[6:18, 6:18, 4:12] = 1
+
+    # GPU-enabled installs must produce the same distance maps as the CPU path
+    for squared_distance in (False, True):
+        gpu = _convert_mask_to_distance_map_gpu(mask, squared_distance=squared_distance)
+        reference = sitk.SignedMaurerDistanceMap(
+            mask,
+            insideIsPositive=True,
+            squaredDistance=squared_distance,
+            useImageSpacing=True,
+        )
+        assert np.allclose(
+            sitk.GetArrayFromImage(gpu), sitk.GetArrayFromImage(reference), atol=1e-4
+        )